@@ -2,12 +2,19 @@
 # Craistlist Scraper Bot
 #  Adam Rodriguez
 from lxml import etree
-from bs4 import BeautifulSoup
+from lxml import html as lxml_html
 from craigslist_scraper.scraper import scrape_html
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 import smtplib
+import string
+import re
 import datetime
 import time
 
@@ -17,10 +24,34 @@ def debug(s):
     if debugging: print(s)
     return
 
+# compiled once and reused for every search results page
+RESULT_XPATH = etree.XPath("//a[contains(concat(' ',normalize-space(@class),' '),' result-title ')]")
+HTML_PARSER = lxml_html.HTMLParser(encoding='utf-8') # craigslist pages are utf-8, even without a <meta charset>
+POST_ID_RE = re.compile(r'/(\d{8,})\.html') # unique post id at the end of a listing url
+WORD_RE = re.compile(r'\w+') # words of a listing title, punctuation is dropped
+
+def ListingKey(url):
+    """
+    Get the key a listing is remembered by in the viewed listings.
+    returns the listing's post id as an int, or the lowercased url if it has no post id.
+    """
+    match = POST_ID_RE.search(url)
+    if match:
+        return int(match.group(1))
+    return url.lower()
+
 class CraigSettings:
     """
     A class
     """
+    # xml tags holding a single value -> attribute it is stored in
+    scalarSettings = {'HasPic': 'hasPic', 'MinPrice': 'minPrice', 'MaxPrice': 'maxPrice',
+                      'MinYear': 'minYear', 'MaxYear': 'maxYear', 'MinMiles': 'minMiles',
+                      'MaxMiles': 'maxMiles', 'TitleStatus': 'titleStatus', 'Receiver': 'recipientEmail',
+                      'Sender': 'senderEmail', 'SenderPwd': 'senderPwd', 'FetchColors': 'fetchColors'}
+    # xml tags holding a list of values -> list attribute they are added to
+    listSettings = {'Cities': 'cities', 'CarModels': 'cars', 'Blacklist': 'blacklist'}
+
     def __init__(self, settings_file):
         """
         Open an xml file containing settings for the scraper bot and initialize variables.
@@ -38,47 +69,45 @@ class CraigSettings:
         self.recipientEmail = None
         self.senderEmail = None
         self.senderPwd = None
-        self.blacklist = [] # keywords found in titles. keyword found in title will exclude the result.
-        self.viewedListings = [] # listings from previous days that have been sent
+        self.fetchColors = False # open every new listing to scrape its paint color
+        self.blacklist = [] # keywords found in titles. keyword found as a word in title will exclude the result.
+        self.viewedListings = set() # post ids of listings from previous days that have been sent
+        self.viewedOrder = [] # same post ids as viewedListings, in the order they were added
         self.urlsToSearch = []
+        self.urlCars = [] # car model searched by the url at the same index in urlsToSearch
 
-        with open("settings.cfg") as settingsFile: # open and parse settings
-            tree = etree.parse(settingsFile)
-        
-        root = tree.getroot()
-
-        for child in root: # get settings from xml root
-            if child.tag == 'Cities':
-                for city in child:
-                    self.cities.append(city.text)
-            if child.tag == 'HasPic':
-                self.hasPic = child.text
-            if child.tag == 'MinPrice':
-                self.minPrice = child.text
-            if child.tag == 'MaxPrice':
-                self.maxPrice = child.text
-            if child.tag == 'CarModels':
-                for car in child:
-                    self.cars.append(car.text)
-            if child.tag == 'MinYear':
-                self.minYear = child.text
-            if child.tag == 'MaxYear':
-                self.maxYear = child.text
-            if child.tag == 'MinMiles':
-                self.minMiles = child.text
-            if child.tag == 'MaxMiles':
-                self.maxMiles = child.text
-            if child.tag == 'TitleStatus':
-                self.titleStatus = int(child.text)
-            if child.tag == 'Receiver':
-                self.recipientEmail = child.text
-            if child.tag == 'Sender':
-                self.senderEmail = child.text
-            if child.tag == 'SenderPwd':
-                self.senderPwd = child.text
-            if child.tag == 'Blacklist':
-                for keyword in child:
-                    self.blacklist.append(keyword.text)
+        # stream the settings, handling each child of the xml root once it is fully parsed
+        root = None
+        for event, child in etree.iterparse(settings_file, events=('start', 'end')):
+            if root is None: # the first event is the start of the root
+                root = child
+            elif event == 'end' and child.getparent() is root:
+                if child.tag in self.scalarSettings:
+                    setattr(self, self.scalarSettings[child.tag], child.text)
+                elif child.tag in self.listSettings:
+                    getattr(self, self.listSettings[child.tag]).extend(item.text for item in child)
+                child.clear() # free the setting once it has been read
+
+        if self.titleStatus != None:
+            self.titleStatus = int(self.titleStatus)
+        if isinstance(self.fetchColors, str):
+            self.fetchColors = self.fetchColors.strip().lower() in ('1', 'true', 'yes')
+
+        # single word keywords are looked up in a set, keywords of several
+        # words (e.g. "new beetle", "e-golf") are matched as a run of words
+        words = set()
+        self._blacklist_phrases = []
+        for keyword in self.blacklist:
+            if keyword == None: # empty <Keyword/>
+                continue
+            tokens = tuple(WORD_RE.findall(keyword.lower()))
+            if len(tokens) == 1:
+                words.add(tokens[0])
+            elif tokens:
+                self._blacklist_phrases.append(tokens)
+            else:
+                debug("IGNORING BLACKLIST KEYWORD WITHOUT ANY WORDS: " + keyword)
+        self._blacklist_set = frozenset(words)
 
         self.LoadViewedListings() # load any previous viewed listings
         self.CreateUrls() # create the urls that the bot will search for
@@ -93,7 +122,9 @@ class CraigSettings:
                     if (line == '\n' or line == '\r\n' or line == ''): # Ignore garbage lines
                         continue
                     line = line.strip()
-                    self.viewedListings.append(line)
+                    key = int(line) if line.isdigit() else ListingKey(line) # older files saved full urls
+                    self.viewedListings.add(key)
+                    self.viewedOrder.append(key)
         except Exception as e:
             print("Failed to load viewed listings: {}".format(e))
                 
@@ -104,7 +135,7 @@ class CraigSettings:
         try:
             with open('viewedListings.txt', 'w') as listings:
                 # reverse list to save the most recent posts
-                for item in reversed(self.viewedListings):
+                for item in reversed(self.viewedOrder):
                     listings.write("{}\n".format(item))
         except Exception as e:
             print("Failed to save viewed listings: {}".format(e))
@@ -118,6 +149,7 @@ class CraigSettings:
             for car in self.cars:
                 url = self.BuildUrl(city, car)
                 self.urlsToSearch.append(url)
+                self.urlCars.append(car)
 
     def BuildUrl(self, cityName, carModel):
         """
@@ -125,59 +157,123 @@ class CraigSettings:
         the defined settings.
         returns the url string.
         """
-        sUrl = "https://" + cityName + ".craigslist.org/search/cta?"
-        sUrl = sUrl + "postedToday=1" # this bot only checks for listings posted the day of
-        sUrl = sUrl + "&searchNearby=0" # exclude nearby results from the main results
-        sUrl = sUrl + "&auto_make_model=" + carModel
+        params = {'postedToday': 1, # this bot only checks for listings posted the day of
+                  'searchNearby': 0, # exclude nearby results from the main results
+                  'auto_make_model': carModel}
 
         # Any settings set to None will be excluded in url
-        if self.hasPic != None:
-            sUrl = sUrl + "&hasPic=" + self.hasPic
-        if self.minPrice != None:
-            sUrl = sUrl + "&min_price=" + self.minPrice
-        if self.maxPrice != None:
-            sUrl = sUrl + "&max_price=" + self.maxPrice
-        if self.minYear != None:
-            sUrl = sUrl + "&min_auto_year=" + self.minYear
-        if self.maxYear != None:
-            sUrl = sUrl + "&max_auto_year=" + self.maxYear
-        if self.minMiles != None:
-            sUrl = sUrl + "&min_auto_miles=" + self.minMiles
-        if self.maxMiles != None:
-            sUrl = sUrl + "&max_auto_miles=" + self.maxMiles
-        if self.titleStatus != None:
-            sUrl = sUrl + "&auto_title_status=" + str(self.titleStatus)
-        
-        return sUrl
+        for key, value in (('hasPic', self.hasPic), ('min_price', self.minPrice),
+                           ('max_price', self.maxPrice), ('min_auto_year', self.minYear),
+                           ('max_auto_year', self.maxYear), ('min_auto_miles', self.minMiles),
+                           ('max_auto_miles', self.maxMiles), ('auto_title_status', self.titleStatus)):
+            if value is not None:
+                params[key] = value
+
+        return "https://" + cityName + ".craigslist.org/search/cta?" + urlencode(params)
 
     def HasBlacklistedWords(self, sentence):
         """
-        Checks if the sentence contains any blacklisted words.
+        Checks if the sentence contains any blacklisted keyword as whole words.
         returns bool.
         """
-        for word in self.urlsToSearch:
-            if word in sentence.lower():
+        words = WORD_RE.findall(sentence.lower())
+        if not self._blacklist_set.isdisjoint(words):
+            return True
+        for phrase in self._blacklist_phrases:
+            n = len(phrase)
+            if any(tuple(words[i:i + n]) == phrase for i in range(len(words) - n + 1)):
                 return True
         return False
 
 
 # Define global vars
 carColors = dict()
-collectedLinks = dict() # Posts for the current day
+collectedLinks = dict() # Posts for the current day, title -> (url, car model)
+TITLE_STATUSES = {1: 'clean', 2:'salvage', 3:'rebuilt'
+                 , 4:'parts only', 5:'lien', 6:'missing'}
+
+# html at the start and end of the email, filled in by BuildMessage
+HEADER_TPL = string.Template("""\
+    <html>
+      <head></head>
+      <body>
+        <p>Hello I'm Craig the Craigslist Scraper Bot!<br>
+               Here are the craigslists listings for today based off the specified criteria*:<br>
+           <ul>
+           <li><b>Cities: </b> $cities</li>
+           <li><b>Cars: </b> $cars</li>
+           <li><b>Minimum Price: </b> $$$minPrice</li>
+           <li><b>Maximum Price: </b> $$$maxPrice</li>
+           <li><b>Minimum Year: </b> $minYear</li>
+           <li><b>Maximum Mileage: </b> $maxMiles miles</li>
+           <li><b>Title Status: </b>$titleStatus</li>
+           </ul>
+           <br><br>
+           """)
+COLOR_NOTE = """
+        * Link color represents car color. If no color can be determined then link color defaults to orange.<br>"""
+FOOTER_TPL = string.Template("""</p>
+        <p><font size="2">$colorNote
+        * All listings are from today ( $date )
+        </font></p>
+        </body>
+    </html>
+    """)
+maxWorkers = 16 # Max number of pages fetched at the same time
+maxPoolSize = 32 # Max number of kept-alive connections per craigslist host
+
+def CreateSession():
+    """
+    Create a requests session that keeps connections alive, asks for
+    compressed responses and retries failed connections.
+    returns the session.
+    """
+    session = requests.Session()
+    session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) Craig/1.0'})
+    adapter = HTTPAdapter(pool_connections=maxWorkers, pool_maxsize=maxPoolSize,
+                          max_retries=Retry(total=10, backoff_factor=1))
+    session.mount('https://', adapter)
+    return session
+
+SESSION = CreateSession() # shared by every request so connections to craigslist are reused
+
+def FetchPage(url):
+    """
+    Get the page at url.
+    returns the response or None if the page could not be fetched.
+    """
+    try:
+        return SESSION.get(url)
+    except Exception as e:
+        debug("FATAL ERROR: FAILED TO CONNECT TO CRAIGSLIST: " + str(e))
+        return None
+
+def GetCarColor(url):
+    """
+    Scrape the paint color from the listing page at url.
+    returns the color or 'orange' if it could not be determined.
+    """
+    try:
+        page = SESSION.get(url)
+        data = scrape_html(page.text)
+        debug(str(data.attrs['paint color']))
+        return data.attrs['paint color']
+    except:
+        debug("FAILED TO GET CAR COLOR. DEFAULT TO ORANGE")
+        return 'orange'
     
-def SendEmail(settings_obj):
+def BuildMessage(settings_obj):
     """
-    Build the body of an email with the collected links
-    and send it to recipient defined in settings_obj.
+    Build an email with the collected links
+    addressed to the recipient defined in settings_obj.
     settings_obj is a Craigsettings class object 
+    returns the message.
     """
     # me == bots email address
     # you == recipient's email address
     me = settings_obj.senderEmail
     you = settings_obj.recipientEmail
-    titleStatuses = {1: 'clean', 2:'salvage', 3:'rebuilt'
-                    , 4:'parts only', 5:'lien', 6:'missing'}
-
     # Create message container - the correct MIME type is multipart/alternative.
     msg = MIMEMultipart('alternative')
     msg['Subject'] = "Craigslist Listings For the Day"
@@ -185,65 +281,34 @@ def SendEmail(settings_obj):
     msg['To'] = you
     
     # Create the body of the message (a plain-text and an HTML version).
-    html = """\
-    <html>
-      <head></head>
-      <body>
-        <p>Hello I'm Craig the Craigslist Scraper Bot!<br>
-               Here are the craigslists listings for today based off the specified criteria*:<br>
-           <ul>
-           <li><b>Cities: </b> """ +  ', '.join(settings_obj.cities) + """</li>
-           <li><b>Cars: </b> """ +  ', '.join(settings_obj.cars) + """</li>
-           <li><b>Minimum Price: </b> $""" + str(settings_obj.minPrice) + """</li>
-           <li><b>Maximum Price: </b> $""" + str(settings_obj.maxPrice) + """</li>
-           <li><b>Minimum Year: </b> """ + str(settings_obj.minYear) + """</li>
-           <li><b>Maximum Mileage: </b> """ + str(settings_obj.maxMiles) + """ miles</li>
-           <li><b>Title Status: </b>""" + titleStatuses[settings_obj.titleStatus] +  """</li>
-           </ul>
-           <br><br>
-           """
+    # pieces of the html are collected in parts and joined once at the end
+    parts = [HEADER_TPL.substitute(cities=', '.join(settings_obj.cities),
+                                   cars=', '.join(settings_obj.cars),
+                                   minPrice=settings_obj.minPrice,
+                                   maxPrice=settings_obj.maxPrice,
+                                   minYear=settings_obj.minYear,
+                                   maxMiles=settings_obj.maxMiles,
+                                   titleStatus=TITLE_STATUSES[settings_obj.titleStatus])]
+
+    linksByCar = defaultdict(list) # group links by the car model they were found with
+    for key, (value, car) in collectedLinks.items():
+        linksByCar[car].append((key, value))
 
-    d = dict() # list of car titles already added to html list
     for car in settings_obj.cars: # order listings by car models
-        html_save = html # copy of html if have to rollback due to no listings found for the car model
-        no_links = True
-        html = html + """<br><font size = "10px"><u><b>""" + str(car[0] + car[1:]) + "</b></u></font><br>"
-        
-        for key, value in collectedLinks.items():
-            if (car in key.lower()):
-                if carColors[value] == 'white': # provide a black bg for any white cars
-                    style="color:white;background: black;"
-                else:
-                    style="color:{};".format(carColors[value])
-                html = html + """<font size = "5px"><a href=""" + "\"" + value + "\" style=\"" + style + "\">" + key + "</a></font><br><br>"
-                d[key] = value
-                no_links = False
-                
-        # Remvoe car header if no results found for car
-        if (no_links == True):
-            html = html_save
-    
-    # Print rest of cars if the correct car category could not be found
-    if (len(d) < len(collectedLinks)):
-        html = html + """<font size = "5px"><u><b>Other</b></u></font><br>"""
-        
-        for key, value in collectedLinks.items():
-            if (key not in d.keys()):
-                if carColors[value] == 'white': # provide a black bg for any white cars
-                    style="color:white;background: black;"
-                else:
-                    style="color:{};".format(carColors[value])
-
-                html = html + """<font size="5px"><a href=""" + "\"" + value + "\" style=\"" + style + "\">" + key + "</a></font><br><br>"
-
-    html = html + """</p>
-        <p><font size="2">
-        * Link color represents car color. If no color can be determined then link color defaults to orange.<br>
-        * All listings are from today ( """ + datetime.datetime.now().strftime("%m/%d/%y") + """ )
-        </font></p>
-        </body>
-    </html>
-    """
+        if car not in linksByCar: # skip car header if no results found for car
+            continue
+        parts.append("""<br><font size = "10px"><u><b>""" + str(car[0] + car[1:]) + "</b></u></font><br>")
+
+        for key, value in linksByCar[car]:
+            if carColors[value] == 'white': # provide a black bg for any white cars
+                style="color:white;background: black;"
+            else:
+                style="color:{};".format(carColors[value])
+            parts.append("""<font size = "5px"><a href=""" + "\"" + value + "\" style=\"" + style + "\">" + key + "</a></font><br><br>")
+
+    parts.append(FOOTER_TPL.substitute(colorNote=COLOR_NOTE if settings_obj.fetchColors else '',
+                                       date=datetime.datetime.now().strftime("%m/%d/%y")))
+    html = ''.join(parts)
     
     # Record the MIME types of both parts - text/plain and text/html.
     body = MIMEText(html, 'html')
@@ -253,22 +318,39 @@ def SendEmail(settings_obj):
     # the HTML message, is best and preferred.
     msg.attach(body)
     # msg.attach(part2)
-    # Send the message via local SMTP server.
+    return msg
+
+def ConnectMail(settings_obj):
+    """
+    Open a connection to the SMTP server and log in
+    with the sender defined in settings_obj.
+    returns the SMTP connection.
+    """
     mail = smtplib.SMTP('smtp.gmail.com', 587)
-    mail.ehlo()
-    mail.starttls()
-    
-    debug("logging in...")
-    mail.login(settings_obj.senderEmail, settings_obj.senderPwd)
+    try:
+        mail.ehlo()
+        mail.starttls()
+        
+        debug("logging in...")
+        mail.login(settings_obj.senderEmail, settings_obj.senderPwd)
+    except:
+        mail.close() # don't leak the socket when the login fails
+        raise
+    return mail
+
+def SendEmail(mail, msg):
+    """
+    Send msg through the already logged in SMTP connection mail.
+    """
     debug("sending email...")
-    mail.sendmail(me, you, msg.as_string().encode('utf-8'))
-    mail.quit()
+    mail.send_message(msg) # sender and recipient are taken from the message headers
 
 
 if __name__ == "__main__":
     sendTime = datetime.time(19, 00) # Time to send email
     bConnecting = True # bool used to break out of the connecting loop
     maxLimit = 75 # Max limit of postings to be saved to viewedListings.txt
+    maxSleep = 300 # Max seconds to sleep before checking the clock again
     craig = CraigSettings("settings.cfg")
  
     # Create the urls for each city/car
@@ -278,87 +360,111 @@ if __name__ == "__main__":
 
     # MAIN LOOP
     while(True):
-        debug("LOOPED. EMAIL TO BE SENT TO " + craig.recipientEmail + " AT " + sendTime.strftime('%I:%M:%S'))
-        debug(datetime.datetime.now().time())
-        time.sleep(15)
+        # Sleep until the next time the email is to be sent
+        now = datetime.datetime.now()
+        target = now.replace(hour=sendTime.hour, minute=sendTime.minute, second=0, microsecond=0)
+        if target <= now: # already past the send time today, wait for tomorrow
+            target += datetime.timedelta(days=1)
+        debug("EMAIL TO BE SENT TO " + craig.recipientEmail + " AT " + target.strftime('%m/%d/%y %I:%M:%S'))
+        # sleep in short chunks and re-read the wall clock, so DST changes
+        # and system suspend cannot make the email go out at the wrong time
+        remaining = (target - now).total_seconds()
+        while remaining > 0:
+            time.sleep(min(remaining, maxSleep))
+            remaining = (target - datetime.datetime.now()).total_seconds()
+
+        # Start Connection To Craigslist page once the send time is reached
+        debug(str(target.time()) + " matches " + str(sendTime) + ": QUERYING...")
         
-        # Start Connection To Craigslist page if the time is 7 o'clock
-        # if (True):
-        if (sendTime.hour == datetime.datetime.now().time().hour and sendTime.minute == datetime.datetime.now().time().minute):
-            debug(str(datetime.datetime.now().time()) + " matches " + str(sendTime) + ": QUERYING...")
+        # Pull data from each url, failed connections are retried by the session
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            pages = list(executor.map(FetchPage, craig.urlsToSearch))
+
+        newListings = [] # (title, url, car model) of listings not viewed before
+        for url, car, r in zip(craig.urlsToSearch, craig.urlCars, pages):
+            if r is None: # skip urls that could not be fetched
+                continue
+
+            try:
+                doc = lxml_html.fromstring(r.content, parser=HTML_PARSER) # decode the raw bytes as utf-8
+            except etree.ParserError as e: # empty body, nothing to search
+                debug("FAILED TO PARSE " + url + ": " + str(e))
+                continue
             
-            # Pull data from each url
-            for url in craig.urlsToSearch:
-                
-                bConnecting = True
-                attempts = 0 # retry 10 times or skip
-                # Attempt to connect to each url, retry until successful
-                while(bConnecting == True and attempts < 10):
-                    try:
-                        r  = requests.get(url)
-                        bConnecting = False
-                    except Exception as e:
-                        debug("FATAL ERROR: FAILED TO CONNECT TO CRAIGSLIST... RETRYING..: " + str(e))
-                        attempts += 1
-                        time.sleep(60)
-                
-                soup = BeautifulSoup(r.text, "html.parser")
-                
-                for result in soup.findAll("a", {"class" : "result-title"}):
+            for result in RESULT_XPATH(doc):
 
-                    list_name = result.contents[0] # Skip the listing if it contains a blacklisted word
-                    if craig.HasBlacklistedWords(list_name) or result.attrs['href'].find('//') == 0: # href with // is a nearby result and will be ignored
-                        continue
+                list_name = result.text_content().strip() # Skip the listing if it contains a blacklisted word
+                href = result.get('href', '')
+                if craig.HasBlacklistedWords(list_name) or href.startswith('//'): # href with // is a nearby result and will be ignored
+                    continue
 
-                    fullUrl = url.split('.')[0] + '.craigslist.org' # chop off search parameters of url
-                    fullUrl = fullUrl + result.attrs['href'] # append listing page url
-                    debug(fullUrl)
+                fullUrl = url.split('.')[0] + '.craigslist.org' # chop off search parameters of url
+                fullUrl = fullUrl + href # append listing page url
+                debug(fullUrl)
 
-                    if (fullUrl.lower() in craig.viewedListings): # Skip duplicate postings
-                        continue
+                urlKey = ListingKey(fullUrl) # key used for viewed listings
+                if urlKey in craig.viewedListings: # Skip duplicate postings
+                    continue
+
+                debug(lxml_html.tostring(result))
+                debug('==================================================')
+                debug('--------------------------------------------------')
+                # debug(dir(result))
+                # debug(result.attrs)
+                # input('waiting for input...')
 
-                    debug(result)
-                    debug('==================================================')
-                    debug('--------------------------------------------------')
-                    # debug(dir(result))
-                    # debug(result.attrs)
-                    # input('waiting for input...')
+                newListings.append((list_name, fullUrl, car))
+                craig.viewedListings.add(urlKey) # add post to already viewed listings
+                craig.viewedOrder.append(urlKey)
+            debug('...\n')
 
-                    # Get color of car (for funsies)
+        # Get color of car (for funsies), this costs one extra request per listing
+        if craig.fetchColors:
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                colors = list(executor.map(GetCarColor, [l[1] for l in newListings]))
+        else:
+            colors = ['orange'] * len(newListings)
+
+        for (list_name, fullUrl, car), color in zip(newListings, colors):
+            carColors[fullUrl] = color
+            collectedLinks[list_name] = (fullUrl, car) # add post to found links
+        
+        
+        debug('# of links to be emailed: ' + str(len(collectedLinks)))
+        bConnecting = True
+        mail = None # SMTP connection, kept open across retries
+        msg = BuildMessage(craig) if len(collectedLinks) > 0 else None
+        while (bConnecting and msg != None):
+            try:
+                if mail == None:
+                    mail = ConnectMail(craig)
+                SendEmail(mail, msg)
+                bConnecting = False
+            except Exception as e:
+                debug(str(e))
+                debug("FAILED TO SEND EMAIL... RETRYING..")
+                if mail != None and not isinstance(e, smtplib.SMTPResponseException): # connection is unusable, reconnect on retry
                     try:
-                        page = requests.get(fullUrl)
-                        data = scrape_html(page.text)
-                        debug(str(data.attrs['paint color']))
-                        carColors[fullUrl] = data.attrs['paint color']
-                    except:
-                        debug("FAILED TO GET CAR COLOR. DEFAULT TO ORANGE")
-                        carColors[fullUrl] = 'orange'
-                                
-                    collectedLinks[list_name] = fullUrl # add post to found links
-                    craig.viewedListings.append(fullUrl.lower()) # add post to already viewed listings
-                debug('...\n')
-            
-            
-            debug('# of links to be emailed: ' + str(len(collectedLinks)))
-            bConnecting = True
-            while (bConnecting and len(collectedLinks) > 0):
-                try:
-                    SendEmail(craig)
-                    bConnecting = False
-                except Exception as e:
-                    debug(str(e))
-                    debug("FAILED TO SEND EMAIL... RETRYING..")
-                    time.sleep(5)
-                
-            debug("*** FINISHED SENDING EMAIL ***")
+                        mail.close()
+                    except Exception as e:
+                        debug(str(e))
+                    mail = None
+                time.sleep(5)
+
+        if mail != None:
+            try:
+                mail.quit()
+            except Exception as e:
+                debug(str(e))
             
-            craig.viewedListings = craig.viewedListings[-maxLimit:] # Truncate viewed listings to max limit
-            craig.SaveViewedListings()
-                
-            debug("FINISHED SAVING LISTINGS TO FILE...")
+        debug("*** FINISHED SENDING EMAIL ***")
+        
+        craig.viewedOrder = craig.viewedOrder[-maxLimit:] # Truncate viewed listings to max limit
+        craig.viewedListings = set(craig.viewedOrder)
+        craig.SaveViewedListings()
             
-            # debug(collectedLinks)
-            collectedLinks = dict()
-            carColors = dict()
-            time.sleep(60)
-
+        debug("FINISHED SAVING LISTINGS TO FILE...")
+        
+        # debug(collectedLinks)
+        collectedLinks = dict()
+        carColors = dict()